@@ -3,14 +3,86 @@
 """A script for backing up your Goodreads statuses."""
 
 import argparse
-import itertools
 import json
+import math
 import re
 import os
+import sys
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util.retry import Retry
+
+# Goodreads serves the statuses pages to browser-like user agents only.
+USER_AGENT = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) '
+              'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/34.0.1847.131 '
+              'Safari/537.36')
+
+# How many pages to fetch at once. Kept small so we don't hammer Goodreads.
+MAX_WORKERS = 4
+
+
+def _make_session():
+    """Returns a requests Session for talking to Goodreads.
+
+    A single session is shared across all page fetches, so the underlying
+    connection is kept alive rather than paying for a new TCP+TLS handshake
+    on every page.
+
+    Requests that fail with a transient error (rate limiting or a server
+    hiccup) are retried with backoff, rather than aborting the whole backup.
+
+    """
+    # If we run out of retries, hand back the last response, so the caller
+    # can report the error code Goodreads gave us.
+    retry = Retry(total=5,
+                  backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False)
+
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    session.headers['Connection'] = 'keep-alive'
+    # Every page comes from the same host, but each worker needs its own
+    # connection to it, or the pool will throw connections away.
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS,
+                          max_retries=retry)
+    session.mount('https://', adapter)
+    return session
+
+
+SESSION = _make_session()
+
+# Separates the book ID from the rest of a book URL slug, e.g.
+# "11.The_Hitchhiker_s_Guide_to_the_Galaxy" or "11-the-hitchhiker-s-guide"
+_BOOK_ID_RE = re.compile(r'[-.]')
+
+# Month abbreviations, as used in dates on the statuses page.
+_MONTHS = {month: number for number, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), start=1)}
+
+# Elements that never have contents, which are written out as e.g. "<br/>".
+_VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link',
+    'meta', 'param', 'source', 'track', 'wbr'))
+
+# Elements whose text is written out exactly as it appears in the page.
+_RAW_TEXT_ELEMENTS = frozenset(('script', 'style'))
+
+# Classes that mark out the parts of a status we need.
+_HEADER_CLASSES = frozenset(('user_status_header',))
+_BODY_CLASSES = frozenset(('readable', 'body'))
+_DATE_CLASSES = frozenset(('greyText', 'uitext', 'smallText'))
+
+# Attributes that hold a space-separated list of values.
+_MULTI_VALUED_ATTRIBUTES = frozenset((
+    'class', 'rel', 'rev', 'accept-charset', 'headers', 'accesskey',
+    'dropzone'))
 
 
 def read_config():
@@ -30,8 +102,8 @@ def read_config():
     try:
         with open("config.json", "r") as config_file:
             config_data = json.load(config_file)
-            user_id = config_data.user_id
-    except FileNotFoundError:
+            user_id = config_data.get('user_id')
+    except (FileNotFoundError, json.JSONDecodeError):
         pass
 
     parser = argparse.ArgumentParser(
@@ -59,42 +131,98 @@ def convert_date_from_page(element):
     date_str = convert_body(element)
     # On the statuses page, dates are returned in the form:
     # "Oct 24, 2016 12:26PM"
-    date_obj = datetime.strptime(date_str, '%b %d, %Y %I:%M%p')
+    # The format never changes, so pick it apart by hand rather than going
+    # through the much slower datetime.strptime.
+    month, day, year, time = date_str.replace(',', '').split()
+    hour, minute = time[:-2].split(':')
+    hour = int(hour) % 12
+    if time[-2:] == 'PM':
+        hour += 12
+    date_obj = datetime(int(year), _MONTHS[month], int(day), hour, int(minute))
     return str(date_obj)
 
 
 def convert_page_count(element):
     try:
-        return int(element.text)
+        return int(element.text())
     except TypeError:
         return None
 
 
 def convert_body(element):
-    return element.text.strip()
+    return element.text().strip()
+
+
+def _escape_html(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _quote_attribute(name, value):
+    value = _escape_html(value or '')
+    if name in _MULTI_VALUED_ATTRIBUTES:
+        value = ' '.join(value.split())
+    if '"' not in value:
+        return '"%s"' % value
+    if "'" not in value:
+        return "'%s'" % value
+    return '"%s"' % value.replace('"', '&quot;')
+
+
+def _node_to_html(node):
+    """Serialise an HTML node following BeautifulSoup's conventions, so that
+    status bodies come out the same as in backups made with it.
+
+    This covers the markup that turns up in status bodies. It is not a
+    complete copy of BeautifulSoup's output, e.g. for markup that
+    BeautifulSoup's parser would have mangled.
+
+    :param node: a selectolax node.
+
+    """
+    if node.is_text_node:
+        return _escape_html(node.text_content)
+    if node.is_comment_node:
+        return node.html
+
+    attributes = ''.join(' %s=%s' % (name, _quote_attribute(name, value))
+                         for name, value in sorted(node.attrs.items()))
+    if node.tag in _VOID_ELEMENTS:
+        return '<%s%s/>' % (node.tag, attributes)
+    if node.tag in _RAW_TEXT_ELEMENTS:
+        contents = ''.join(child.text_content
+                           for child in node.iter(include_text=True))
+    else:
+        contents = ''.join(map(_node_to_html, node.iter(include_text=True)))
+    return '<%s%s>%s</%s>' % (node.tag, attributes, contents, node.tag)
 
 
 def convert_status_body(element):
-    # Extract status text, complete with any line-breaks
-    return ''.join(map(str, element.contents)).strip()
+    # Extract status text, complete with any line-breaks.
+    # Text directly in the body is left unescaped, as it always has been.
+    contents = []
+    for child in element.iter(include_text=True):
+        if child.is_text_node:
+            contents.append(child.text_content)
+        elif child.is_comment_node:
+            # Strip the "<!--" and "-->"
+            contents.append(child.html[4:-3])
+        else:
+            contents.append(_node_to_html(child))
+    return ''.join(contents).strip()
 
 
-def _get_data_from_goodreads_site(user_id, page_no):
+def _get_data_from_goodreads_site(user_id, page_no, session=SESSION):
     """Retrieve data about the statuses of a given user from the Goodreads site.
     Returns a Request object if successful, raises an Exception if not.
 
     :param user_id: The ID of the Goodreads user.
     :param page_no: Which page of statuses to fetch.
+    :param session: The requests Session to make the request with.
 
     """
     # user_status.list gets all the statuses by a user.
-    user_agent = ('Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_2) '
-                  'AppleWebKit/537.36 (KHTML, like Gecko) Chrome/34.0.1847.131 '
-                  'Safari/537.36')
-    req = requests.get('https://www.goodreads.com/user_status/list/' + user_id,
-                       params={'page': str(page_no)},
-                       headers={'User-Agent': user_agent}
-                       )
+    req = session.get('https://www.goodreads.com/user_status/list/' + user_id,
+                      params={'page': str(page_no)})
 
     if req.status_code != 200:
         raise Exception('Unexpected error code from Goodreads API: %s\n'
@@ -102,6 +230,51 @@ def _get_data_from_goodreads_site(user_id, page_no):
     return req
 
 
+def _extract_progress(progress_text):
+    """Work out reading progress from the header of a Goodreads status.
+    Returns a dictionary with the percentage, plus the page details if known.
+
+    :param progress_text: the text of a status header between the user's name
+        and the book title, e.g. " is on page 18 of 216 of ".
+
+    """
+    # The progress string can be in one of four formats:
+    # 1: User is Z% done with Book_Title
+    # 2: User is on page X of Y of Book_Title
+    # 3: User is reading Book_Title
+    # 4: User is finished with Book_Title
+    #
+    # If we get #1, we know the percentage, but we don't have any page number info.
+    # If we get #2, we can calculate the percentage from the page number info.
+    # If we get #3, we can assume no progress yet (0% done).
+    # If we get #4, we know they're finished, so 100% done.
+    words = progress_text.split()
+    if words[:1] == ['is']:
+        words = words[1:]
+
+    try:
+        if words[:2] == ['on', 'page'] and words[3:4] == words[5:6] == ['of']:
+            # Format #2
+            page_no = int(words[2])
+            total_pages = int(words[4])
+            return {'page_no': page_no,
+                    'total_pages': total_pages,
+                    'percentage': page_no * 100 // total_pages}
+        if words[1:3] == ['done', 'with'] and words[0].endswith('%'):
+            # Format #1
+            return {'percentage': int(words[0][:-1])}
+    except (ValueError, ZeroDivisionError):
+        pass
+
+    if 'finished' in progress_text:
+        # Format #4
+        return {'percentage': 100}
+
+    # Format #3, or something we don't recognise. Either way, assume no
+    # progress yet.
+    return {'percentage': 0}
+
+
 def _extract_status_from_element(element):
     """Retrieve status information from HTML of Goodreads page.
     Parses HTML elements to extract relevant data.
@@ -118,7 +291,7 @@ def _extract_status_from_element(element):
     # <BOOK COVER>
     # <br/>
 
-    content = element.div.find('div', {'class': 'left'})
+    content = element.css_first('div.left')
 
     # This retrieves an element that should be structured as follows:
     # <div class="left" style="float: left; width: 495px;">
@@ -139,89 +312,152 @@ def _extract_status_from_element(element):
     #
     #   </div>
 
-    status['status'] = convert_status_body(
-        content.find('div', {'class': 'readable body'}))
+    # Pick out the parts we need in a single pass over the element, rather
+    # than searching the whole element again for each one. As with a search,
+    # the first match for each part wins.
+    progress_element = body_element = date_element = None
+    for node in content.traverse():
+        classes = frozenset((node.attrs.get('class') or '').split())
+        if progress_element is None and _HEADER_CLASSES <= classes:
+            progress_element = node
+        elif body_element is None and _BODY_CLASSES <= classes:
+            body_element = node
+        elif (date_element is None and node.tag == 'span'
+              and _DATE_CLASSES <= classes):
+            date_element = node
+        if (progress_element is not None and body_element is not None
+                and date_element is not None):
+            break
+
+    date_id_element = None
+    if date_element is not None:
+        date_id_element = date_element.css_first('a')
+    for part, part_element in (('header', progress_element),
+                               ('body', body_element),
+                               ('date link', date_id_element)):
+        if part_element is None:
+            raise Exception('Unexpected status layout, could not find the '
+                            'status %s in:\n%s' % (part, content.html))
+
+    status['status'] = convert_status_body(body_element)
 
-    date_id_element = content.find('span', {
-        'class': 'greyText uitext smallText'
-    }).a
     status['date'] = convert_date_from_page(date_id_element)
-    status['status_id'] = date_id_element['href'].split('/')[-1]
+    status['status_id'] = date_id_element.attrs['href'].rpartition('/')[2]
 
-    progress_element = content.find('span', {'class': 'user_status_header'})
-    book_title_link = progress_element.find('a', {'rel': 'nofollow'})
+    book_title_link = progress_element.css_first('a[rel~="nofollow"]')
     if not book_title_link:
         return ""
-    status['book_title'] = convert_body(book_title_link)
-    status['book_id'] = re.split('[-.]',
-                                 book_title_link['href'].split('/')[-1])[0]
-
-    # The progress string can be in one of four formats:
-    # 1: User is Z% done with Book_Title
-    # 2: User is on page X of Y of Book_Title
-    # 3: User is reading Book_Title
-    # 4: User is finished with Book_Title
-    #
-    # If we get #1, we know the percentage, but we don't have any page number info.
-    # If we get #2, we can calculate the percentage from the page number info.
-    # If we get #3, we can assume no progress yet (0% done).
-    # If we get #4, we know they're finished, so 100% done.
-    progress_text = convert_body(progress_element)
-    progress_values = re.search(
-        '.* is (?:on page )?(\d*%?) (?:of (\d*) of|done with) .*',
-        progress_text, re.S)
-
-    if not progress_values:
-        if 'finished' in progress_text:
-            # Format #4
-            status['percentage'] = 100
+    # Most books have many statuses, so share one copy of the title and ID
+    # between all of them.
+    status['book_title'] = sys.intern(convert_body(book_title_link))
+    book_slug = book_title_link.attrs['href'].rpartition('/')[2]
+    status['book_id'] = sys.intern(_BOOK_ID_RE.split(book_slug)[0])
+
+    # The progress sits between the links to the user and the book. Only
+    # look at the text there, so that neither the user's name nor the book
+    # title can be mistaken for it.
+    progress_text = []
+    for node in progress_element.iter(include_text=True):
+        if node.is_text_node:
+            progress_text.append(node.text_content)
+        elif node.mem_id == book_title_link.mem_id:
+            break
+        elif node.tag == 'a':
+            progress_text = []
         else:
-            # Format #3
-            status['percentage'] = 0
-    elif progress_values.group(1)[-1] == '%':
-        # Format #1
-        status['percentage'] = int(progress_values.group(1)[:-1])
-    else:
-        # Format #2
-        status['page_no'] = int(progress_values.group(1))
-        status['total_pages'] = int(progress_values.group(2))
-        status['percentage'] = int(
-            int(status['page_no']) / int(status['total_pages']) * 100)
+            progress_text.append(node.text())
+    status.update(_extract_progress(''.join(progress_text)))
 
     return status
 
 
-def get_statuses(user_id):
-    """Generate statuses associated with a Goodreads user.
+def _extract_statuses_from_page(tree):
+    """Retrieve all statuses from a page of the Goodreads site.
 
-    :param user_id: The ID of the Goodreads user.
+    :param tree: a page of statuses, parsed by selectolax.
 
     """
-    page_no = itertools.count()
+    # Extract all statuses from this page, converting each from HTML to a
+    # dictionary
+    return [_extract_status_from_element(element)
+            for element in tree.css("div.elementList")]
+
+
+def _get_statuses_from_site(user_id, page_no, session=SESSION):
+    """Retrieve a single page of statuses from the Goodreads site.
+    Returns a list of statuses.
+
+    :param user_id: The ID of the Goodreads user.
+    :param page_no: Which page of statuses to fetch.
+    :param session: The requests Session to make the request with.
 
-    # Get an initial page, so we know how many statuses there are to get
-    req = _get_data_from_goodreads_site(user_id=user_id, page_no=next(page_no))
-    soup = BeautifulSoup(req.text, "html.parser")
+    """
+    req = _get_data_from_goodreads_site(user_id=user_id,
+                                        page_no=page_no,
+                                        session=session)
+    tree = LexborHTMLParser(req.content)
+    return _extract_statuses_from_page(tree)
 
-    # The status count should be at the top of the page in the following format:
-    # "Showing 1-30 of 123"
-    # We only need the total count.
-    page_count_text = soup.find("span", {"class": "smallText"}).string.strip()
-    total_status_count = int(page_count_text.split()[-1])
 
-    statuses = []
+def get_statuses(user_id, session=SESSION):
+    """Generate statuses associated with a Goodreads user.
 
-    # Iterate til we have all the statuses
-    while len(statuses) < total_status_count:
-        req = _get_data_from_goodreads_site(user_id=user_id,
-                                            page_no=next(page_no))
-        soup = BeautifulSoup(req.text, "html.parser")
+    :param user_id: The ID of the Goodreads user.
+    :param session: The requests Session to fetch pages with.
 
-        # Extract all statuses from this page
-        status_elements = soup.findAll("div", {"class": "elementList"})
-        for element in status_elements:
-            # Convert status HTML to dictionary
-            statuses.append(_extract_status_from_element(element))
+    """
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    try:
+        # Nearly everyone has more than one page of statuses, so start on the
+        # second page while we wait for the first. If it turns out there is
+        # no second page, we just throw it away.
+        second_page = executor.submit(_get_statuses_from_site,
+                                      user_id, 2, session)
+
+        # Get the first page, so we know how many statuses there are to get
+        req = _get_data_from_goodreads_site(user_id=user_id, page_no=1,
+                                            session=session)
+        tree = LexborHTMLParser(req.content)
+
+        # The status count should be at the top of the page in the following
+        # format: "Showing 1-30 of 123"
+        # We only need the total count.
+        page_count_text = tree.css_first("span.smallText").text().strip()
+        total_status_count = int(page_count_text.rsplit(None, 1)[-1])
+
+        statuses = _extract_statuses_from_page(tree)
+
+        # Goodreads decides how many statuses go on each page, so go by how
+        # many came back on the first one.
+        if len(statuses) >= total_status_count:
+            page_count = 1
+        elif not statuses:
+            raise Exception('Goodreads reports %d statuses, but the first page '
+                            'has none' % total_status_count)
+        else:
+            page_count = math.ceil(total_status_count / len(statuses))
+
+        if page_count > 1:
+            # Now we know how many pages there are, fetch the rest of them at
+            # once. Queue them up before waiting on the second page, so a slow
+            # second page doesn't hold them up. executor.map hands the pages
+            # back in order, whenever they finish.
+            pages = executor.map(
+                lambda page_no: _get_statuses_from_site(user_id, page_no,
+                                                        session),
+                range(3, page_count + 1))
+            statuses.extend(second_page.result())
+            for page in pages:
+                statuses.extend(page)
+    finally:
+        # By now we have every page we need. Don't wait on anything else,
+        # like the second page for a user who only has one.
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if len(statuses) != total_status_count:
+        warnings.warn('Goodreads reports %d statuses, but %d were backed up. '
+                      'Were statuses added or deleted during the backup?'
+                      % (total_status_count, len(statuses)))
 
     return statuses
 
@@ -234,10 +470,9 @@ def _dump_json_to_disk(data, output_dir, filename):
     :param filename: The name of the output file.
 
     """
-    json_str = json.dumps(data, indent=2, sort_keys=True)
     file_path = os.path.join(output_dir, filename)
     with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(json_str)
+        json.dump(data, f, indent=2, sort_keys=True)
 
 
 def write_statuses_to_disk(statuses, output_dir):
@@ -0,0 +1,242 @@
+"""Tests for backup_goodreads."""
+
+import threading
+
+import pytest
+from selectolax.lexbor import LexborHTMLParser
+
+import backup_goodreads
+
+
+@pytest.mark.parametrize('progress_text, expected', [
+    # Format #1
+    (' is 25% done with ', {'percentage': 25}),
+    # Format #2
+    (' is on page 18 of 216 of ',
+     {'page_no': 18, 'total_pages': 216, 'percentage': 8}),
+    # Format #3
+    (' is reading ', {'percentage': 0}),
+    # Format #4
+    (' is finished with ', {'percentage': 100}),
+    (' finished reading ', {'percentage': 100}),
+    # Headers are spread over several lines on the page
+    ('\n        is on page 29 of 100 of\n        ',
+     {'page_no': 29, 'total_pages': 100, 'percentage': 29}),
+    # Malformed progress falls back to no progress, rather than failing
+    (' is on page 18 of ', {'percentage': 0}),
+    (' is on page 18 of 0 of ', {'percentage': 0}),
+    (' is % done with ', {'percentage': 0}),
+    (' wrote a review of ', {'percentage': 0}),
+    ('', {'percentage': 0}),
+])
+def test_extract_progress(progress_text, expected):
+    assert backup_goodreads._extract_progress(progress_text) == expected
+
+
+@pytest.mark.parametrize('body, expected', [
+    ('I like reading!', 'I like reading!'),
+    # Text directly in the body is written out unescaped
+    ('Tea &amp; biscuits &lt;3', 'Tea & biscuits <3'),
+    # Tags are written out as BeautifulSoup did
+    ('One<br>Two<br />Three', 'One<br/>Two<br/>Three'),
+    ('A <b>bold &amp; brave</b> <i>claim</i>',
+     'A <b>bold &amp; brave</b> <i>claim</i>'),
+    ('<a rel="nofollow  noopener" href="/book/show/1?a=1&amp;b=2">Book</a>',
+     '<a href="/book/show/1?a=1&amp;b=2" rel="nofollow noopener">Book</a>'),
+    ('<img src="cover.jpg" alt> <span title=\'say "hi"\'>hi</span>',
+     '<img alt="" src="cover.jpg"/> <span title=\'say "hi"\'>hi</span>'),
+    ('<!-- note --> <b>x<!-- inner --></b>', 'note  <b>x<!-- inner --></b>'),
+    # Text in script and style elements is left as it is
+    ('<script>if (a<b) x &amp;&amp; y</script>',
+     '<script>if (a<b) x &amp;&amp; y</script>'),
+    ('x <style>a > b { content: "&" }</style>',
+     'x <style>a > b { content: "&" }</style>'),
+])
+def test_convert_status_body(body, expected):
+    html = '<div class="readable body">\n  %s\n</div>' % body
+    element = LexborHTMLParser(html).css_first('div')
+    assert backup_goodreads.convert_status_body(element) == expected
+
+
+_HEADER = ('<span class="uitext greyText inlineblock stacked user_status_header">'
+           '<a href="/user/show/1234-johnsmith">John Smith</a> '
+           'is on page 18 of 216 of <a href="https://www.goodreads.com/book/'
+           'show/11.The_Book" rel="nofollow">The Book</a></span>')
+_BODY = '<div class="readable body">I like reading!</div>'
+_DATE = ('<span class="greyText uitext smallText">&mdash; <a class="greyText" '
+         'href="/user_status/show/12402">Sep 06, 2008 05:25AM</a></span>')
+_LIKES = ('<span class="greyText smallText uitext likes">'
+          '<a href="/rating/voters/1">2 likes</a></span>')
+
+
+def _extract_status(content):
+    html = '<div class="elementList"><div><div class="left">%s</div></div></div>'
+    element = LexborHTMLParser(html % content).css_first('div.elementList')
+    return backup_goodreads._extract_status_from_element(element)
+
+
+@pytest.mark.parametrize('content', [
+    _HEADER + _BODY + _DATE,
+    # Parts wrapped in other elements are still found
+    '<div>%s</div><div><div>%s</div></div><p>%s</p>' % (_HEADER, _BODY, _DATE),
+    # Later grey small text, like a likes line, doesn't replace the date
+    _HEADER + _BODY + _DATE + _LIKES,
+    _HEADER + _BODY + _DATE + _BODY.replace('I like', 'Not'),
+])
+def test_extract_status_from_element(content):
+    assert _extract_status(content) == {
+        'status': 'I like reading!',
+        'date': '2008-09-06 05:25:00',
+        'status_id': '12402',
+        'book_title': 'The Book',
+        'book_id': '11',
+        'page_no': 18,
+        'total_pages': 216,
+        'percentage': 8,
+    }
+
+
+@pytest.mark.parametrize('content, part', [
+    (_BODY + _DATE, 'header'),
+    (_HEADER + _DATE, 'body'),
+    (_HEADER + _BODY, 'date link'),
+    (_HEADER + _BODY +
+     '<span class="greyText uitext smallText">&mdash;</span>', 'date link'),
+])
+def test_extract_status_from_element_missing_part(content, part):
+    with pytest.raises(Exception, match='could not find the status ' + part):
+        _extract_status(content)
+
+
+def _header(name, progress, title):
+    return ('<span class="uitext greyText inlineblock stacked '
+            'user_status_header"><a href="/user/show/1234-user">%s</a>%s'
+            '<a href="https://www.goodreads.com/book/show/11.Book" '
+            'rel="nofollow">%s</a></span>' % (name, progress, title))
+
+
+@pytest.mark.parametrize('header, expected', [
+    # Neither the user's name nor the book title is mistaken for progress
+    (_header('This is Me', ' is on page 5 of 10 of ', 'Book'),
+     {'page_no': 5, 'total_pages': 10, 'percentage': 50}),
+    (_header('Jo is 99% done with it', ' is reading ', 'Book'),
+     {'percentage': 0}),
+    (_header('John Smith', ' is reading ', 'The 100% done with it Guide'),
+     {'percentage': 0}),
+    (_header('John Smith', ' is reading ', 'What is on page 5 of 10 of This'),
+     {'percentage': 0}),
+    (_header('John Smith', ' is reading ', 'The Unfinished Novel'),
+     {'percentage': 0}),
+    (_header('John Smith', ' is 40% done with ', 'I am on page 3 of 4 of It'),
+     {'percentage': 40}),
+    (_header('John Smith', ' is on page 3 of 1000 of ', 'Tale of Two Cities'),
+     {'page_no': 3, 'total_pages': 1000, 'percentage': 0}),
+    (_header('John Smith', ' is finished with ', 'Book'),
+     {'percentage': 100}),
+    (_header('John Smith', ' finished reading ', 'Book'),
+     {'percentage': 100}),
+])
+def test_extract_status_from_element_progress(header, expected):
+    status = _extract_status(header + _BODY + _DATE)
+    progress = {key: status[key] for key in
+                ('page_no', 'total_pages', 'percentage') if key in status}
+    assert progress == expected
+
+
+def _status_html(status_no):
+    return '''
+<div class="elementList">
+  <div>
+    <div class="left">
+      <span class="uitext greyText inlineblock stacked user_status_header">
+        <a href="/user/show/1234-johnsmith">John Smith</a>
+        is reading <a href="https://www.goodreads.com/book/show/11.Book" rel="nofollow">Book</a>
+      </span>
+      <div class="readable body">Status %d</div>
+      <span class="greyText uitext smallText">
+        &mdash; <a class="greyText" href="/user_status/show/%d">Sep 06, 2008 05:25AM</a>
+      </span>
+    </div>
+  </div>
+</div>''' % (status_no, status_no)
+
+
+class FakeSession:
+    """Serves pages of statuses, like the Goodreads statuses list."""
+
+    def __init__(self, total, per_page, reported_total=None):
+        self.total = total
+        self.per_page = per_page
+        self.reported_total = total if reported_total is None else reported_total
+
+    def get(self, url, params):
+        page_no = int(params['page'])
+        first = (page_no - 1) * self.per_page
+        last = min(first + self.per_page, self.total)
+        statuses = ''.join(_status_html(status_no)
+                           for status_no in range(first, last))
+        html = ('<html><body><span class="smallText">Showing %d-%d of %d</span>'
+                '%s</body></html>' % (first + 1, last, self.reported_total,
+                                      statuses))
+
+        class Response:
+            status_code = 200
+            text = html
+            content = html.encode('utf-8')
+
+        return Response()
+
+
+@pytest.mark.parametrize('total, per_page', [
+    (0, 30), (20, 30), (30, 30), (123, 30), (123, 20),
+])
+def test_get_statuses_fetches_every_page(total, per_page):
+    statuses = backup_goodreads.get_statuses('1', FakeSession(total, per_page))
+    assert [status['status_id'] for status in statuses] == \
+        [str(status_no) for status_no in range(total)]
+
+
+def test_get_statuses_warns_on_missing_statuses():
+    with pytest.warns(UserWarning, match='reports 70 statuses, but 65'):
+        statuses = backup_goodreads.get_statuses(
+            '1', FakeSession(65, 30, reported_total=70))
+    assert len(statuses) == 65
+
+
+class BlockingSession(FakeSession):
+    """Holds back the second page until another page has been requested."""
+
+    def __init__(self, total, per_page, release_page):
+        super().__init__(total, per_page)
+        self.release_page = release_page
+        self.released = threading.Event()
+        self.second_page_done = False
+
+    def get(self, url, params):
+        page_no = int(params['page'])
+        if page_no == 2:
+            try:
+                assert self.released.wait(timeout=5)
+            finally:
+                self.second_page_done = True
+        elif page_no == self.release_page:
+            self.released.set()
+        return super().get(url, params)
+
+
+def test_get_statuses_does_not_wait_for_unneeded_second_page():
+    # Page 2 is only released once the test is over.
+    session = BlockingSession(20, 30, release_page=None)
+    try:
+        statuses = backup_goodreads.get_statuses('1', session)
+        assert len(statuses) == 20
+        assert not session.second_page_done
+    finally:
+        session.released.set()
+
+
+def test_get_statuses_fetches_later_pages_while_waiting_on_second_page():
+    # Page 2 is only released once page 3 has been asked for.
+    session = BlockingSession(65, 30, release_page=3)
+    statuses = backup_goodreads.get_statuses('1', session)
+    assert len(statuses) == 65